@@ -1,13 +1,167 @@
+import importlib.util
+import mmap
 import os 
 import sys 
 
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
 
+try:
+    # Optional: fuses the magnetic magnitude calculation in a single pass
+    import numexpr as ne
+except ImportError:
+    ne = None
+
+# Prefer the C++ protobuf backend for deserializing the recordings, when the
+# installed protobuf ships it. It has to be selected before any _pb2 import!
+if importlib.util.find_spec('google.protobuf.pyext._message') is not None:
+    os.environ.setdefault('PROTOCOL_BUFFERS_PYTHON_IMPLEMENTATION', 'cpp')
+
 import ips_protocol.recordings_pb2 as proto
 
-recordings_proto = proto.Recording()
+
+def _parse_recording(pb_file: str) -> tuple([dict, dict]):
+    """Reads the positions and magnetics columns of a recordings file.
+    This is the only place where the protobuf messages are touched.
+    Parameters
+    ----------
+    pb_file : str
+        The absolute path of the recordings (google protobuf file)
+    Returns
+    -------
+    positions : dict
+        The np.array columns 't', 'x', 'y', 'floor', 'type', 'accuracy'
+    magnetics : dict
+        The np.array columns 't', 'mx', 'my', 'mz', 'accuracy'
+    """
+
+    # Deserialize binary into a new message of the proto class
+    # "Recording" (nothing is shared between calls). The file is
+    # memory mapped and parsed in place instead of being copied first
+    measurements = proto.Recording()
+    with open(pb_file, 'rb') as f, \
+            mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        measurements.ParseFromString(mm)
+
+    # Build every column in one pass over the repeated fields, so that the
+    # DataFrames can be created at once (appending rows reallocates them)
+    n_pos = len(measurements.positions)
+    n_mag = len(measurements.magnetics)
+
+    positions = {
+        't': np.fromiter((p.t for p in measurements.positions),
+                         dtype=np.float64, count=n_pos),
+        'x': np.fromiter((p.x for p in measurements.positions),
+                         dtype=np.float64, count=n_pos),
+        'y': np.fromiter((p.y for p in measurements.positions),
+                         dtype=np.float64, count=n_pos),
+        'floor': np.fromiter((p.floor for p in measurements.positions),
+                             dtype=np.int64, count=n_pos),
+        'type': np.fromiter((p.type for p in measurements.positions),
+                            dtype=np.int64, count=n_pos),
+        'accuracy': np.fromiter((p.accuracy for p in measurements.positions),
+                                dtype=np.float64, count=n_pos)
+        }
+
+    # The magnetics 'x', 'y', 'z' are stored directly as 'mx', 'my', 'mz'
+    magnetics = {
+        't': np.fromiter((m.t for m in measurements.magnetics),
+                         dtype=np.float64, count=n_mag),
+        'mx': np.fromiter((m.x for m in measurements.magnetics),
+                          dtype=np.float64, count=n_mag),
+        'my': np.fromiter((m.y for m in measurements.magnetics),
+                          dtype=np.float64, count=n_mag),
+        'mz': np.fromiter((m.z for m in measurements.magnetics),
+                          dtype=np.float64, count=n_mag),
+        'accuracy': np.fromiter((m.accuracy for m in measurements.magnetics),
+                                dtype=np.float64, count=n_mag)
+        }
+
+    return positions, magnetics
+
+
+def _interp_positions(pt: np.ndarray, px: np.ndarray, py: np.ndarray,
+                      mt: np.ndarray) -> tuple([np.ndarray, np.ndarray]):
+    """Interpolates the positions (px, py) at times pt to the times mt.
+    Parameters
+    ----------
+    pt, px, py : (N,) np.array
+        The ground truth timestamps (sorted) and positions
+    mt : (M,) np.array
+        The timestamps to calculate positions for
+    Returns
+    -------
+    x, y : (M,) np.array
+        The interpolated positions
+    Raises
+    ------
+    ValueError
+        If there are less than 2 ground truth positions
+    """
+
+    if len(pt) < 2:
+        raise ValueError("At least 2 ground truth positions are needed for "
+                         f"the interpolation, got {len(pt)}!")
+
+    # Index i of the ground truth positions i, i+1 bracketing each
+    # timestamp. Timestamps before the first ground truth are
+    # extrapolated from the first route
+    idx = np.searchsorted(pt, mt, side='right') - 1
+    idx = np.clip(idx, 0, len(pt) - 2)
+
+    # Speed for routes between 2 consecutive ground truth positions
+    # It is assumed CONST between consecutive ground truth positions
+    # NOTE: A route of zero duration (duplicated timestamps, picked only at
+    # the clipped ends) has no speed. Its later position is used then
+    dt = pt[idx + 1] - pt[idx]
+    moving = dt > 0
+    speed_x = np.divide(px[idx + 1] - px[idx], dt,
+                        out=np.zeros(len(dt)), where=moving)
+    speed_y = np.divide(py[idx + 1] - py[idx], dt,
+                        out=np.zeros(len(dt)), where=moving)
+    idx = np.where(moving, idx, idx + 1)
+
+    return (mt - pt[idx]) * speed_x + px[idx], (mt - pt[idx]) * speed_y + py[idx]
+
+
+def _grid_average(row: np.ndarray, col: np.ndarray, values: np.ndarray,
+                  shape: tuple) -> np.ndarray:
+    """Averages values falling inside the same (row, col) cell of a grid.
+    Parameters
+    ----------
+    row, col : (M,) np.array
+        The integer cell indices of each value (negative indices wrap around
+        as in numpy indexing)
+    values : (M,) np.array
+        The values to average
+    shape : (N, K) tuple
+        The shape of the grid
+    Returns
+    -------
+    grid : (N, K) np.array
+        The average value per cell (NaN for empty cells)
+    Raises
+    ------
+    IndexError
+        If any (row, col) index is out of the bounds of the grid
+    """
+
+    nrows, ncols = shape
+
+    # Same bounds as numpy indexing, so the wrapping below never folds a
+    # value into an unrelated cell
+    outside = (row < -nrows) | (row >= nrows) | (col < -ncols) | (col >= ncols)
+    if outside.any():
+        raise IndexError(f"{np.count_nonzero(outside)} values fall outside "
+                         f"of the {nrows} x {ncols} grid!")
+
+    # Sum and number of the values inside each cell
+    flat = (row % nrows) * ncols + col % ncols
+    sums = np.bincount(flat, weights=values, minlength=nrows*ncols)
+    cnt = np.bincount(flat, minlength=nrows*ncols)
+
+    return np.divide(sums, cnt, out=np.full(nrows*ncols, np.nan),
+                     where=cnt > 0).reshape(nrows, ncols)
 
 
 class IPSRecording:
@@ -76,55 +230,33 @@ class IPSRecording:
             The pandas dataframe containing the magnetics measurements.
         """
 
-        with open(self.pb_file, 'rb') as f:
-            file = f.read()
-            # Deserialize binary based on the proto class "Recordings"
-            measurements = recordings_proto.FromString(file)
+        positions, magnetics = _parse_recording(self.pb_file)
 
-        # Only the columns 't', 'x', 'y', 'z' are necessary!
-        # The columns name 'must' be hardcoded (?)
-        self.positions = pd.DataFrame(
-            columns = ['t', 'x', 'y', 'floor', 'type', 'accuracy']
-            )
-        self.magnetics = pd.DataFrame(
-            columns = ['t', 'mx', 'my', 'mz', 'accuracy']
-            )
-
-        # TODO: Maybe there is faster way?
-        for i, position in enumerate(measurements.positions):
-            self.positions.loc[i] = [
-                position.t,
-                position.x,
-                position.y,
-                position.floor,
-                position.type,
-                position.accuracy
-                ]
-
-        for j, magnetic in enumerate(measurements.magnetics):
-            self.magnetics.loc[j] = [
-                magnetic.t,
-                magnetic.x,
-                magnetic.y,
-                magnetic.z,
-                magnetic.accuracy
-                ]
-
-        # Renaming the columns of magnetics!
-        self.magnetics.rename(columns = {'x': 'mx', 'y': 'my', 'z': 'mz'},
-                             inplace=True)
-        
-        # Initialize the columns 'x' and 'y' -> positions to be calculated
-        self.magnetics['x'] = 0.0
-        self.magnetics['y'] = 0.0
+        # Extent of the ground truth positions, computed once for all the
+        # calculations (they are sorted by time, so the last 't' is the max)
+        self._tmax = positions['t'][-1]
+        self._xmin, self._xmax = positions['x'].min(), positions['x'].max()
+        self._ymin, self._ymax = positions['y'].min(), positions['y'].max()
 
         # NOTE: Discard magnetics measurements recorded after the last ground
         # truth measurement! Impossible to calculate their position!
+        # Both are sorted by time, so the magnetics are truncated (views)
+        cutoff = np.searchsorted(magnetics['t'], self._tmax, side='right')
+        magnetics = {column: values[:cutoff]
+                     for column, values in magnetics.items()}
+
+        # The columns used in the calculations are kept as contiguous float64
+        # arrays, so that they don't go through pandas on every access
+        self._pt, self._px, self._py = \
+            positions['t'], positions['x'], positions['y']
+        self._mt, self._mx, self._my, self._mz = \
+            magnetics['t'], magnetics['mx'], magnetics['my'], magnetics['mz']
 
-        self.magnetics = self.magnetics[
-                self.magnetics['t']<=self.positions['t'].max()
-                ]
+        self.positions = pd.DataFrame(positions)
 
+        # The columns 'x' and 'y' -> positions to be calculated are
+        # initialized in the same call
+        self.magnetics = pd.DataFrame({**magnetics, 'x': 0.0, 'y': 0.0})
 
         return self.positions, self.magnetics
 
@@ -143,39 +275,11 @@ class IPSRecording:
         None
         """
         
-        tj = self.magnetics.loc[0]['t']
-        row = 0
-
-        for i in self.positions.index[:-1]:
-            # Speed for routes between 2 consecutive ground truth positions
-            # It is assumed CONST between consecutive ground truth positions
-            speed_x = \
-                (self.positions.loc[i+1]['x'] - self.positions.loc[i]['x']) /\
-                (self.positions.loc[i+1]['t'] - self.positions.loc[i]['t'])
-
-            speed_y = \
-                (self.positions.loc[i+1]['y'] - self.positions.loc[i]['y']) /\
-                (self.positions.loc[i+1]['t'] - self.positions.loc[i]['t'])
-
-            # Calculate position for each magnetic in between i, i+1 ground 
-            # truth positions. 
-            # NOTE: We could assume constant time lapse for each measurement
-            # and do this faster but it seems it is not exactly constant due
-            # to rounding errors
-            while tj < self.positions.loc[i+1]['t']:
-                self.magnetics.loc[row,'x'] = (tj - self.positions.loc[i]['t']) * speed_x + self.positions.loc[i]['x']
-                
-                self.magnetics.loc[row,'y'] = (tj - self.positions.loc[i]['t']) * speed_y + self.positions.loc[i]['y']
-                        
-                row += 1
-
-                # We exit the calculation as soon as we reach the end of the 
-                # magnetics measurements or when the magnetics timestamp gets
-                # greater positions.t.max() which we expect to never happen! 
-                if row >= len(self.magnetics.index):
-                    return None
-                
-                tj = self.magnetics.loc[row]['t']
+        # The magnetics positions are kept as arrays for set_rect_grid too
+        self._x, self._y = _interp_positions(self._pt, self._px, self._py,
+                                             self._mt)
+        self.magnetics['x'] = self._x
+        self.magnetics['y'] = self._y
 
         return None
 
@@ -203,44 +307,53 @@ class IPSRecording:
         self.cell_size = cell_size
         
         # I use positions instead of magnetics because they are far less
-        # (faster to find min, max) and the calculation is still correct
-        x_axis = [i for i in range(int(np.floor(self.positions.x.min())), 
-                                  int(np.ceil(self.positions.x.max())),
-                                  self.cell_size[0])
-                                  ]
-        y_axis = [i for i in range(int(np.floor(self.positions.y.min())),
-                                  int(np.ceil(self.positions.y.max())),
-                                  self.cell_size[1])
-                                  ]
-
-        # The average magnetic values per cell. This is returned
-        self.rect_grid = np.zeros((len(x_axis) + 1, len(y_axis) + 1))
-        # The number of magnetics encountered inside each cell
-        cnt = np.zeros((len(x_axis) + 1, len(y_axis) + 1))
-
-        x_min = self.positions.x.min()
-        y_min = self.positions.y.min()
-
-        # maxY = len(y_axis) 
-        # maxX = len(x_axis)
-
-        for _, magnetic in self.magnetics.iterrows():
-            row = -int(np.ceil(magnetic['x'] - x_min) // self.cell_size[0]) 
-            col = -int(np.ceil(magnetic['y'] - y_min) // self.cell_size[1])  
-
-            self.rect_grid[row, col] += np.sqrt(pow(magnetic['mx'],2) 
-                                                + pow(magnetic['my'],2)
-                                                + pow(magnetic['mz'],2)
-                                                )
-                                                
-                                        
-            cnt[row, col] += 1
-
-        # NOTE: to avoid runtime error division by zero add 1 to each zero cell
-        cnt [cnt == 0] = np.NaN
-        self.rect_grid = np.divide(self.rect_grid, cnt)
+        # (faster to find min, max) and the calculation is still correct.
+        # They are found once in read_recording
+        x_min, x_max = self._xmin, self._xmax
+        y_min, y_max = self._ymin, self._ymax
+
+        # Shape of the grid of the average magnetic values per cell: the
+        # number of cell_size steps from floor(min) to ceil(max), plus one
+        x_span = int(np.ceil(x_max) - np.floor(x_min))
+        y_span = int(np.ceil(y_max) - np.floor(y_min))
+        nrows = -(-x_span // self.cell_size[0]) + 1
+        ncols = -(-y_span // self.cell_size[1]) + 1
+
+        if not (np.isfinite(self._x).all() and np.isfinite(self._y).all()):
+            raise ValueError("The magnetics positions must be finite to "
+                             "find the cells of the grid!")
+
+        # Cell of every magnetic measurement. The operations are done in
+        # place to avoid an intermediate array per step
+        row = np.subtract(self._x, x_min)
+        np.ceil(row, out=row)
+        np.floor_divide(row, self.cell_size[0], out=row)
+        np.negative(row, out=row)
+        row = row.astype(np.intp)
+
+        col = np.subtract(self._y, y_min)
+        np.ceil(col, out=col)
+        np.floor_divide(col, self.cell_size[1], out=col)
+        np.negative(col, out=col)
+        col = col.astype(np.intp)
+
+        mx, my, mz = self._mx, self._my, self._mz
+
+        if ne is not None:
+            mag = ne.evaluate('sqrt(mx*mx + my*my + mz*mz)')
+        else:
+            # Squares as products (no np.power dispatch), summed in place
+            mag = mx*mx
+            mag += my*my
+            mag += mz*mz
+            np.sqrt(mag, out=mag)
+
+        self.rect_grid = _grid_average(row, col, mag, (nrows, ncols))
         
         if plot:
+            # Imported only when needed, as loading matplotlib is slow
+            import matplotlib.pyplot as plt
+
             plt.figure()
             plt.title(f'''Average magnetic value for recording 
             {os.path.basename(self.pb_file)} and 
@@ -2,7 +2,7 @@ import unittest
 import numpy as np
 import pandas as pd
 from unittest.mock import patch
-from main import IPSRecording
+from main import IPSRecording, _grid_average, _interp_positions
 
 
 class TestIPSRecording(unittest.TestCase):
@@ -51,6 +51,16 @@ class TestIPSRecording(unittest.TestCase):
         self.assertEqual(self.ips_recording.magnetics.iloc[0]['x'], expected_first_x)
         self.assertEqual(self.ips_recording.magnetics.iloc[0]['y'], expected_first_y)
 
+    def test_magnetics_pos_calc_within_ground_truth(self):
+        self.ips_recording.magnetics_pos_calc()
+
+        positions = self.ips_recording.positions
+        magnetics = self.ips_recording.magnetics
+
+        # Interpolated positions must lie between the ground truth positions
+        self.assertTrue(magnetics['x'].between(positions['x'].min(), positions['x'].max()).all())
+        self.assertTrue(magnetics['y'].between(positions['y'].min(), positions['y'].max()).all())
+
     def test_set_rect_grid(self):
         self.ips_recording.read_recording()
         self.ips_recording.magnetics_pos_calc()
@@ -72,6 +82,68 @@ class TestIPSRecording(unittest.TestCase):
         print("Expected grid shape: ", expected_shape)
         self.assertEqual(actual_shape, expected_shape, "The shape of the grid does not match the expected shape.")
 
+    def test_set_rect_grid_average(self):
+        cell_size = [5, 5]
+        rect_grid = self.ips_recording.set_rect_grid(cell_size, plot=False)
+
+        positions = self.ips_recording.positions
+        expected_sum = np.zeros(rect_grid.shape)
+        expected_cnt = np.zeros(rect_grid.shape)
+        for _, magnetic in self.ips_recording.magnetics.iterrows():
+            row = -int(np.ceil(magnetic['x'] - positions['x'].min()) // cell_size[0])
+            col = -int(np.ceil(magnetic['y'] - positions['y'].min()) // cell_size[1])
+            expected_sum[row, col] += np.sqrt(magnetic['mx']**2 + magnetic['my']**2 + magnetic['mz']**2)
+            expected_cnt[row, col] += 1
+        expected_cnt[expected_cnt == 0] = np.nan
+
+        np.testing.assert_allclose(rect_grid, expected_sum / expected_cnt, equal_nan=True)
+
+
+class TestInterpPositions(unittest.TestCase):
+
+    def test_interpolation(self):
+        pt = np.array([0.0, 1.0, 3.0])
+        px = np.array([0.0, 2.0, 2.0])
+        py = np.array([0.0, 0.0, 4.0])
+
+        x, y = _interp_positions(pt, px, py, np.array([-1.0, 0.5, 1.0, 2.0, 3.0]))
+
+        # Before the first ground truth the first route is extrapolated
+        np.testing.assert_allclose(x, [-2.0, 1.0, 2.0, 2.0, 2.0])
+        np.testing.assert_allclose(y, [0.0, 0.0, 0.0, 2.0, 4.0])
+
+    def test_duplicated_last_timestamp(self):
+        pt = np.array([0.0, 1.0, 1.0])
+        px = np.array([0.0, 1.0, 5.0])
+        py = np.array([0.0, 2.0, 6.0])
+
+        x, y = _interp_positions(pt, px, py, np.array([0.5, 1.0]))
+
+        np.testing.assert_allclose(x, [0.5, 5.0])
+        np.testing.assert_allclose(y, [1.0, 6.0])
+
+    def test_single_position(self):
+        with self.assertRaises(ValueError):
+            _interp_positions(np.array([0.0]), np.array([1.0]), np.array([1.0]), np.array([0.0]))
+
+
+class TestGridAverage(unittest.TestCase):
+
+    def test_average(self):
+        row = np.array([0, 0, -1, 1])
+        col = np.array([0, 0, -2, 0])
+        values = np.array([1.0, 3.0, 5.0, 7.0])
+
+        grid = _grid_average(row, col, values, (2, 2))
+
+        # Negative indices wrap around as in numpy indexing
+        np.testing.assert_allclose(grid, [[2.0, np.nan], [6.0, np.nan]], equal_nan=True)
+
+    def test_outside_of_grid(self):
+        for row, col in (([2], [0]), ([-3], [0]), ([0], [2]), ([0], [-3])):
+            with self.assertRaises(IndexError):
+                _grid_average(np.array(row), np.array(col), np.array([1.0]), (2, 2))
+
 
 if __name__ == '__main__':
     unittest.main()